@@ -2,91 +2,230 @@ import asyncio
 import logging
 import os
 import re
-from typing import Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Dict, List, Optional, Tuple
 
 import aiosqlite
-from aiogram import Bot, Dispatcher, F, types
+from aiogram import Bot, Dispatcher, F, Router, flags, types
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import (Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, 
                            ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton)
+from aiogram.utils.callback_answer import CallbackAnswer, CallbackAnswerMiddleware
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.filters.callback_data import CallbackData
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
 # --- 1. CONFIGURATION ---
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_API_TOKEN")
 ADMIN_IDS_STR = os.getenv("ADMIN_IDS", "")
-ADMIN_IDS = [int(admin_id) for admin_id in ADMIN_IDS_STR.split(',') if admin_id.isdigit()]
+ADMIN_IDS = frozenset(int(admin_id) for admin_id in ADMIN_IDS_STR.split(',') if admin_id.isdigit())
 DB_NAME = 'streeteda.db'
-
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+DB_STATEMENT_CACHE = 128  # sqlite3's default, made explicit; the app issues ~35 distinct statements, so all stay prepared
+DB_READERS = 4  # read-only connections served alongside the single writer
+CART_CACHE_SIZE = 1000  # most recently used carts kept in memory
+PHONE_DIGITS_RE = re.compile(r'\D')
+NEG_ANSWERS = frozenset({'нет', 'no', '-'})
+SETTING_PROMPTS = {
+    'delivery_fee': "Введите новую стоимость доставки:",
+    'free_delivery_threshold': "Введите новый порог для бесплатной доставки:",
+}
+DB: Optional[aiosqlite.Connection] = None  # shared write connection, opened in main()
+DB_LOCK = asyncio.Lock()  # serializes writes on the shared connection
+READERS: asyncio.Queue = asyncio.Queue()  # idle read connections, filled in main()
+
+# In-memory copies of rarely changing data, refreshed after admin edits
+CATEGORIES_CACHE: List[Tuple[int, str]] = []
+ITEMS_BY_CAT: Dict[int, List[Tuple[int, str, float]]] = {}
+SETTINGS_CACHE: Dict[str, float] = {}
+# Per-user carts as {user_id: {item_id: (name, price, quantity)}}, loaded from the DB on first use, LRU-bounded
+CART_CACHE: 'OrderedDict[int, Dict[int, Tuple[str, float, int]]]' = OrderedDict()
+# Menu keyboards built from the caches above, rebuilt lazily after each refresh
+_CATEGORIES_MARKUP: Optional[InlineKeyboardMarkup] = None
+_ADMIN_CATEGORIES_MARKUP: Optional[InlineKeyboardMarkup] = None
+_ITEMS_MARKUP: Dict[int, InlineKeyboardMarkup] = {}
+
+# Configure logging: handlers only enqueue records, a background thread writes them out
+_log_queue = SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(_log_queue, _log_stream)
+log_listener.start()
+logging.root.addHandler(QueueHandler(_log_queue))
+logging.root.setLevel(logging.INFO)
+log = logging.getLogger("bot")
 
 # --- 2. DATABASE (aiosqlite for async) ---
-async def db_query(query, params=(), fetchone=False, commit=False, fetchall=False):
-    """Asynchronous database query function."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute(query, params)
-        if commit:
-            await db.commit()
-            return None
-        if fetchone:
-            return await cursor.fetchone()
-        if fetchall:
-            return await cursor.fetchall()
-        return await cursor.fetchall()
+async def open_db(query_only=False):
+    """Opens a connection and applies the per-connection PRAGMAs."""
+    db = await aiosqlite.connect(DB_NAME, cached_statements=DB_STATEMENT_CACHE)
+    await db.execute('PRAGMA busy_timeout=30000')
+    await db.execute('PRAGMA synchronous=NORMAL')
+    await db.execute('PRAGMA temp_store=MEMORY')
+    await db.execute('PRAGMA mmap_size=268435456')
+    await db.execute('PRAGMA cache_size=-64000')
+    await db.execute('PRAGMA foreign_keys=ON')
+    if query_only:
+        await db.execute('PRAGMA query_only=ON')
+    return db
+
+@asynccontextmanager
+async def reader():
+    """Checks out a read connection from the pool for the duration of the block."""
+    db = await READERS.get()
+    try:
+        yield db
+    finally:
+        READERS.put_nowait(db)
+
+async def db_execute(query, params=()):
+    """Executes a write statement on the shared connection and commits it."""
+    async with DB_LOCK:
+        try:
+            await DB.execute(query, params)
+        except BaseException:
+            await DB.rollback()
+            raise
+        await DB.commit()
+
+async def db_fetchone(query, params=()):
+    """Returns the first row of a query on a pooled read connection."""
+    async with reader() as db, db.execute(query, params) as cursor:
+        return await cursor.fetchone()
+
+async def db_fetchall(query, params=()):
+    """Returns all rows of a query on a pooled read connection."""
+    async with reader() as db:
+        return await db.execute_fetchall(query, params)
+
+@asynccontextmanager
+async def transaction():
+    """Runs the enclosed statements as a single write transaction on the shared connection."""
+    async with DB_LOCK:
+        await DB.execute('BEGIN IMMEDIATE')
+        try:
+            yield DB
+        except BaseException:
+            await DB.rollback()
+            raise
+        await DB.commit()
 
 async def populate_db():
     """Populates the database with initial data if it's empty."""
-    count = await db_query("SELECT COUNT(*) FROM categories", fetchone=True)
+    count = await db_fetchone("SELECT COUNT(*) FROM categories")
     if count and count[0] > 0:
-        logging.info("Database already populated. Skipping.")
+        log.info("Database already populated. Skipping.")
         return
 
-    logging.info("Populating database with initial menu data...")
+    log.info("Populating database with initial menu data...")
     categories_to_add = [('Шаурма',), ('Люля-кебаб',), ('Гарниры',), ('Добавки',), ('Другое',)]
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.executemany("INSERT INTO categories (name) VALUES (?)", categories_to_add)
-        cursor = await db.execute("SELECT id, name FROM categories")
-        cat_map = {name: id for id, name in await cursor.fetchall()}
+    async with transaction():
+        await DB.executemany("INSERT INTO categories (name) VALUES (?)", categories_to_add)
+        cat_map = {name: id for id, name in await DB.execute_fetchall("SELECT id, name FROM categories")}
         items_to_add = [
             ('Стандартная (400 грамм)', 'Классическая шаурма', 230, cat_map['Шаурма']), ('Мини (300 грамм)', 'Уменьшенная порция классики', 200, cat_map['Шаурма']), ('Сырная шаурма (500 грамм)', 'Шаурма с добавлением сыра', 250, cat_map['Шаурма']), ('Барбекю шаурма (500 грамм)', 'С фирменным соусом барбекю', 250, cat_map['Шаурма']), ('Гранатовая шаурма (500 грамм)', 'С пикантным гранатовым соусом', 250, cat_map['Шаурма']), ('По-мексикански шаурма (500 грамм)', 'Острая шаурма с халапеньо', 250, cat_map['Шаурма']), ('ХХЛ шаурма (600 грамм)', 'Огромная и сытная', 290, cat_map['Шаурма']), ('Шаурма без мяса (Веган)', 'Свежие овощи и соус в лаваше', 180, cat_map['Шаурма']), ('Гиро (500 грамм)', 'Греческая шаурма с картофелем фри внутри', 250, cat_map['Шаурма']), ('Сосиска в лаваше', 'Сосиска с овощами и соусом', 170, cat_map['Шаурма']), ('Шаурма с наггетсами', 'Шаурма с куриными наггетсами', 270, cat_map['Шаурма']), ('Люля-кебаб из свинины в лаваше', None, 300, cat_map['Люля-кебаб']), ('Люля-кебаб из говядины в лаваше', None, 300, cat_map['Люля-кебаб']), ('Картофель фри (100 гр)', 'Классический картофель фри', 100, cat_map['Гарниры']), ('Картофель по-деревенски (100 гр)', 'Аппетитные дольки картофеля', 100, cat_map['Гарниры']), ('Наггетсы (5 шт)', 'Куриные наггетсы', 100, cat_map['Гарниры']), ('Бургер-Хит', 'Наш фирменный бургер', 300, cat_map['Другое']), ('Доп. Картофель фри', None, 30, cat_map['Добавки']), ('Доп. Огурцы соленые', None, 30, cat_map['Добавки']), ('Доп. Сыр', None, 30, cat_map['Добавки']), ('Доп. Халапеньо', None, 30, cat_map['Добавки']), ('Доп. Мясо', None, 70, cat_map['Добавки']), ('Доп. Сосиска', None, 40, cat_map['Добавки']),
         ]
-        await db.executemany("INSERT INTO menu_items (name, description, price, category_id) VALUES (?, ?, ?, ?)", items_to_add)
-        await db.commit()
-    logging.info("Database population complete.")
+        await DB.executemany("INSERT INTO menu_items (name, description, price, category_id) VALUES (?, ?, ?, ?)", items_to_add)
+    log.info("Database population complete.")
+
+# Bump SCHEMA_VERSION whenever SCHEMA_SQL changes so existing databases re-run it on the next start
+SCHEMA_VERSION = 1
+SCHEMA_SQL = f'''
+PRAGMA journal_mode=WAL;
+BEGIN;
+CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS menu_items (id INTEGER PRIMARY KEY, name TEXT NOT NULL,
+    description TEXT, price REAL NOT NULL, photo_id TEXT, category_id INTEGER,
+    FOREIGN KEY (category_id) REFERENCES categories (id) ON DELETE CASCADE);
+CREATE TABLE IF NOT EXISTS cart (user_id INTEGER, item_id INTEGER, quantity INTEGER,
+    PRIMARY KEY (user_id, item_id), FOREIGN KEY (item_id) REFERENCES menu_items (id) ON DELETE CASCADE);
+CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY, user_id INTEGER, user_name TEXT,
+    phone_number TEXT, delivery_type TEXT, address TEXT, comment TEXT, total_amount REAL,
+    status TEXT DEFAULT 'new', created_at DATETIME DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE IF NOT EXISTS order_items (id INTEGER PRIMARY KEY, order_id INTEGER, item_name TEXT,
+    quantity INTEGER, price_per_item REAL, FOREIGN KEY (order_id) REFERENCES orders (id));
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value REAL);
+CREATE INDEX IF NOT EXISTS idx_menu_items_cat ON menu_items (category_id);
+CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id);
+CREATE INDEX IF NOT EXISTS idx_cart_item ON cart (item_id);
+INSERT OR IGNORE INTO settings (key, value) VALUES ('delivery_fee', 400);
+INSERT OR IGNORE INTO settings (key, value) VALUES ('free_delivery_threshold', 1000);
+PRAGMA user_version = {SCHEMA_VERSION};
+COMMIT;
+'''
 
 async def init_db():
     """Initializes the database and creates tables if they don't exist."""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute('CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY)')
-        await db.execute('CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)')
-        await db.execute('''CREATE TABLE IF NOT EXISTS menu_items (id INTEGER PRIMARY KEY, name TEXT NOT NULL,
-                          description TEXT, price REAL NOT NULL, photo_id TEXT, category_id INTEGER,
-                          FOREIGN KEY (category_id) REFERENCES categories (id))''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS cart (user_id INTEGER, item_id INTEGER, quantity INTEGER,
-                          PRIMARY KEY (user_id, item_id), FOREIGN KEY (item_id) REFERENCES menu_items (id))''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY, user_id INTEGER, user_name TEXT,
-                          phone_number TEXT, delivery_type TEXT, address TEXT, comment TEXT, total_amount REAL,
-                          status TEXT DEFAULT 'new', created_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-        await db.execute('''CREATE TABLE IF NOT EXISTS order_items (id INTEGER PRIMARY KEY, order_id INTEGER, item_name TEXT,
-                          quantity INTEGER, price_per_item REAL, FOREIGN KEY (order_id) REFERENCES orders (id))''')
-        await db.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value REAL)')
-        for admin_id in ADMIN_IDS:
-            await db.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (admin_id,))
-        await db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('delivery_fee', 400)")
-        await db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('free_delivery_threshold', 1000)")
-        await db.commit()
+    async with DB_LOCK:
+        [(user_version,)] = await DB.execute_fetchall('PRAGMA user_version')
+        if user_version < SCHEMA_VERSION:
+            await DB.executescript(SCHEMA_SQL)
+        await DB.executemany("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", [(admin_id,) for admin_id in ADMIN_IDS])
+        await DB.commit()
     await populate_db()
+    await refresh_menu_cache()
+    SETTINGS_CACHE.update(await db_fetchall("SELECT key, value FROM settings"))
+
+async def refresh_menu_cache():
+    """Reloads categories and menu items into the in-memory cache."""
+    global _CATEGORIES_MARKUP, _ADMIN_CATEGORIES_MARKUP
+    categories = await db_fetchall("SELECT id, name FROM categories ORDER BY id")
+    items = await db_fetchall("SELECT id, name, price, category_id FROM menu_items ORDER BY name")
+    items_by_cat = {}
+    for item_id, name, price, cat_id in items:
+        items_by_cat.setdefault(cat_id, []).append((item_id, name, price))
+    CATEGORIES_CACHE[:] = categories
+    ITEMS_BY_CAT.clear()
+    ITEMS_BY_CAT.update(items_by_cat)
+    CART_CACHE.clear()  # cached carts hold item names and prices
+    _CATEGORIES_MARKUP = _ADMIN_CATEGORIES_MARKUP = None
+    _ITEMS_MARKUP.clear()
+
+async def get_cart(user_id: int):
+    """Returns the user's cart as {item_id: (name, price, quantity)}, loading it on a cache miss."""
+    cart = CART_CACHE.get(user_id)
+    if cart is not None:
+        CART_CACHE.move_to_end(user_id)
+        return cart
+    # Loaded under the write lock: cart writes update the cache under it too, so no write can land between read and store
+    async with DB_LOCK:
+        cart = CART_CACHE.get(user_id)
+        if cart is None:
+            rows = await DB.execute_fetchall('''SELECT mi.id, mi.name, mi.price, c.quantity FROM cart c 
+                                                JOIN menu_items mi ON c.item_id = mi.id WHERE c.user_id = ?''', (user_id,))
+            cart = {item_id: (name, price, quantity) for item_id, name, price, quantity in rows}
+            CART_CACHE[user_id] = cart
+            if len(CART_CACHE) > CART_CACHE_SIZE:
+                CART_CACHE.popitem(last=False)
+    return cart
 
 # --- 3. BOT & FSM INITIALIZATION ---
-bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.MARKDOWN)
+class KeepAliveSession(AiohttpSession):
+    """Bot API session whose pooled connections outlive the polling interval."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # aiogram 3.4.1 builds its TCPConnector from _connector_init and takes no connector argument
+        self._connector_init.update(ttl_dns_cache=300, keepalive_timeout=75)
+
+bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.MARKDOWN, session=KeepAliveSession())
 dp = Dispatcher()
+admin_router = Router()
+admin_router.callback_query.filter(F.from_user.id.in_(ADMIN_IDS))
+admin_router.callback_query.middleware(CallbackAnswerMiddleware(pre=True, cache_time=1))
 
 class OrderState(StatesGroup):
     awaiting_name = State()
@@ -119,51 +258,85 @@ class AdminCallback(CallbackData, prefix="admin"):
     setting_key: Optional[str] = None
     
 # --- 5. UI & LOGIC FUNCTIONS (USER) ---
+# Static keyboards are built once at import and shared; they are never mutated.
+MAIN_MENU_KB = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="🍴 Меню")]], resize_keyboard=True)
+CONTACT_KB = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="📱 Отправить мой контакт", request_contact=True)]],
+                                 resize_keyboard=True, one_time_keyboard=True)
+DELIVERY_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🏃 Самовывоз", callback_data='delivery:takeaway'),
+     InlineKeyboardButton(text="🚚 Доставка", callback_data='delivery:delivery')]
+])
+CONFIRM_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Да, подтвердить", callback_data='confirm_order')],
+    [InlineKeyboardButton(text="❌ Отмена", callback_data='cancel_order')]
+])
+ADMIN_PANEL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Управление товарами", callback_data=AdminCallback(action="manage_items").pack())],
+    [InlineKeyboardButton(text="⚙️ Настройки", callback_data=AdminCallback(action="settings").pack())]
+])
+ADMIN_CANCEL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❌ Отмена", callback_data=AdminCallback(action="back_to_main").pack())]
+])
+
 def get_main_menu_keyboard():
-    return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="🍴 Меню")]], resize_keyboard=True)
+    return MAIN_MENU_KB
+
+async def edit_message(chat_id: int, message_id: int, text: str, markup, current_text: Optional[str] = None):
+    """Edits a bot message, sending only the keyboard when the text is unchanged."""
+    if current_text == text:
+        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=markup)
+    else:
+        await bot.edit_message_text(text, chat_id, message_id, reply_markup=markup)
 
 async def show_categories(message: Message, message_id: Optional[int] = None):
-    categories = await db_query("SELECT id, name FROM categories ORDER BY id")
-    builder = InlineKeyboardBuilder()
-    for cat_id, name in categories:
-        builder.button(text=name, callback_data=CategoryCallback(id=cat_id))
-    builder.adjust(2)
-    builder.row(InlineKeyboardButton(text="🛒 Корзина", callback_data='view_cart'))
+    global _CATEGORIES_MARKUP
+    if _CATEGORIES_MARKUP is None:
+        builder = InlineKeyboardBuilder()
+        for cat_id, name in CATEGORIES_CACHE:
+            builder.button(text=name, callback_data=CategoryCallback(id=cat_id))
+        builder.adjust(2)
+        builder.row(InlineKeyboardButton(text="🛒 Корзина", callback_data='view_cart'))
+        _CATEGORIES_MARKUP = builder.as_markup()
+    markup = _CATEGORIES_MARKUP
     text = "👇 Выберите категорию:"
     try:
         if message_id:
-            await bot.edit_message_text(text, message.chat.id, message_id, reply_markup=builder.as_markup())
+            await bot.edit_message_text(text, message.chat.id, message_id, reply_markup=markup)
         else:
-            await message.answer(text, reply_markup=builder.as_markup())
+            await message.answer(text, reply_markup=markup)
     except Exception as e:
-        logging.error(f"Error in show_categories: {e}")
+        log.error("Error in show_categories: %s", e)
         if message_id:
-            await message.answer(text, reply_markup=builder.as_markup())
+            await message.answer(text, reply_markup=markup)
 
 async def show_items_in_category(query: CallbackQuery, category_id: int):
-    items = await db_query("SELECT id, name, price FROM menu_items WHERE category_id = ? ORDER BY name", (category_id,))
-    builder = InlineKeyboardBuilder()
-    for item_id, name, price in items:
-        builder.button(text=f"{name} - {int(price)} руб.", callback_data=ItemCallback(id=item_id))
-    builder.adjust(1)
-    builder.row(InlineKeyboardButton(text="⬅️ Назад к категориям", callback_data='back_to_categories'))
-    await query.message.edit_text("Выберите товар:", reply_markup=builder.as_markup())
+    markup = _ITEMS_MARKUP.get(category_id)
+    if markup is None:
+        builder = InlineKeyboardBuilder()
+        for item_id, name, price in ITEMS_BY_CAT.get(category_id, []):
+            builder.button(text=f"{name} - {int(price)} руб.", callback_data=ItemCallback(id=item_id))
+        builder.adjust(1)
+        builder.row(InlineKeyboardButton(text="⬅️ Назад к категориям", callback_data='back_to_categories'))
+        markup = _ITEMS_MARKUP[category_id] = builder.as_markup()
+    await query.message.edit_text("Выберите товар:", reply_markup=markup)
 
 async def show_cart(chat_id: int, message_id: Optional[int] = None, message: Optional[Message] = None):
-    cart_items = await db_query('''SELECT mi.id, mi.name, mi.price, c.quantity FROM cart c 
-                                   JOIN menu_items mi ON c.item_id = mi.id WHERE c.user_id = ?''', (chat_id,))
+    cart = await get_cart(chat_id)
     builder = InlineKeyboardBuilder()
-    text = "🛒 *Ваша корзина:*\n\n"
-    if not cart_items:
+    if not cart:
         text = "🛒 Ваша корзина пуста."
         builder.button(text="⬅️ В меню", callback_data='back_to_categories')
     else:
-        total_price = sum(price * quantity for _, _, price, quantity in cart_items)
-        for item_id, name, price, quantity in cart_items:
-            text += f"▪️ {name} ({int(price)}р) x {quantity} = {int(price * quantity)}р\n"
+        parts = ["🛒 *Ваша корзина:*\n\n"]
+        total_price = 0
+        for item_id, (name, price, quantity) in cart.items():
+            line_total = price * quantity
+            total_price += line_total
+            parts.append(f"▪️ {name} ({int(price)}р) x {quantity} = {int(line_total)}р\n")
             builder.button(text=f"❌ Удалить {name}", callback_data=RemoveFromCartCallback(item_id=item_id))
         builder.adjust(1)
-        text += f"\n*Итого: {int(total_price)} руб.*"
+        parts.append(f"\n*Итого: {int(total_price)} руб.*")
+        text = "".join(parts)
         builder.row(InlineKeyboardButton(text="✅ Оформить заказ", callback_data='checkout'))
         builder.row(InlineKeyboardButton(text="🗑️ Очистить", callback_data='clear_cart'),
                     InlineKeyboardButton(text="⬅️ В меню", callback_data='back_to_categories'))
@@ -173,18 +346,16 @@ async def show_cart(chat_id: int, message_id: Optional[int] = None, message: Opt
         elif message:
             await message.answer(text, reply_markup=builder.as_markup())
     except Exception as e:
-        logging.error(f"Error editing cart message: {e}")
+        log.error("Error editing cart message: %s", e)
         if message_id and message:
             await message.answer(text, reply_markup=builder.as_markup())
 
 async def confirm_order(message: Message, state: FSMContext):
     data = await state.get_data()
     chat_id = message.chat.id
-    cart_items = await db_query('''SELECT mi.name, mi.price, c.quantity FROM cart c JOIN menu_items mi 
-                                   ON c.item_id = mi.id WHERE c.user_id = ?''', (chat_id,))
-    subtotal = sum(price * quantity for _, price, quantity in cart_items)
-    settings_list = await db_query("SELECT key, value FROM settings")
-    settings = {key: value for key, value in settings_list}
+    cart_items = [(item_id, name, price, quantity) for item_id, (name, price, quantity) in (await get_cart(chat_id)).items()]
+    subtotal = sum(price * quantity for _, _, price, quantity in cart_items)
+    settings = SETTINGS_CACHE
     delivery_cost = 0
     delivery_cost_text = ""
     if data['delivery_type'] == 'delivery':
@@ -194,7 +365,8 @@ async def confirm_order(message: Message, state: FSMContext):
         else:
             delivery_cost_text = f"🚛 *Доставка:* Бесплатно (заказ от {int(settings['free_delivery_threshold'])} руб.)\n"
     final_total = subtotal + delivery_cost
-    await state.update_data(final_total=final_total)
+    await state.update_data(final_total=final_total, subtotal=subtotal,
+                            cart_snapshot=cart_items)
     delivery_text = 'Самовывоз' if data['delivery_type'] == 'takeaway' else 'Доставка'
     text = (f"🔍 *Проверьте ваш заказ:*\n\n"
             f"👤 *Имя:* {data['name']}\n"
@@ -204,27 +376,46 @@ async def confirm_order(message: Message, state: FSMContext):
         text += f"📍 *Адрес:* {data.get('address', 'Не указан')}\n"
     if 'comment' in data:
         text += f"💬 *Комментарий:* {data['comment']}\n"
-    text += "\n*Состав заказа:*\n" + "\n".join([f"▪️ {name} x {q} шт." for name, _, q in cart_items])
+    text += "\n*Состав заказа:*\n" + "\n".join([f"▪️ {name} x {q} шт." for _, name, _, q in cart_items])
     text += f"\n\n📦 *Товары:* {int(subtotal)} руб.\n"
     text += delivery_cost_text
     text += f"💰 *Итого к оплате: {int(final_total)} руб.*\n\nВсё верно?"
     await state.set_state(OrderState.awaiting_final_confirmation)
-    markup = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Да, подтвердить", callback_data='confirm_order')],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data='cancel_order')]
-    ])
-    await message.answer(text, reply_markup=markup)
+    await message.answer(text, reply_markup=CONFIRM_KB)
 
 async def process_final_confirmation(query: CallbackQuery, state: FSMContext):
     chat_id = query.from_user.id
     data = await state.get_data()
-    cart_items = await db_query('''SELECT mi.id, mi.name, mi.price, c.quantity FROM cart c 
-                                   JOIN menu_items mi ON c.item_id = mi.id WHERE c.user_id = ?''', (chat_id,))
+    cart_items = data.get('cart_snapshot')
     if not cart_items:
         await query.message.answer("Ваша корзина пуста.", reply_markup=get_main_menu_keyboard())
         await state.clear()
         return
     final_total = data.get('final_total', 0)
+    reviewed = {item_id: (name, price, quantity) for item_id, name, price, quantity in cart_items}
+    order_id = None
+    async with transaction():
+        # The review message's menu stays usable, and admins may edit or delete items meanwhile
+        rows = await DB.execute_fetchall('''SELECT mi.id, mi.name, mi.price, c.quantity FROM cart c
+                                            JOIN menu_items mi ON c.item_id = mi.id WHERE c.user_id = ?''', (chat_id,))
+        live = {item_id: (name, price, quantity) for item_id, name, price, quantity in rows}
+        if live == reviewed:
+            cursor = await DB.execute('''INSERT INTO orders (user_id, user_name, phone_number, delivery_type, address, comment, total_amount)
+                                         VALUES (?, ?, ?, ?, ?, ?, ?)''', (chat_id, data['name'], data['phone'], data['delivery_type'],
+                                         data.get('address', ''), data.get('comment', ''), final_total))
+            order_id = cursor.lastrowid
+            await DB.executemany('INSERT INTO order_items (order_id, item_name, quantity, price_per_item) VALUES (?, ?, ?, ?)',
+                                 [(order_id, name, quantity, price) for _, name, price, quantity in cart_items])
+            await DB.execute("DELETE FROM cart WHERE user_id = ?", (chat_id,))
+        CART_CACHE.pop(chat_id, None)
+    if order_id is None:
+        if not live:
+            await query.message.answer("Ваша корзина пуста.", reply_markup=get_main_menu_keyboard())
+            await state.clear()
+        else:
+            await query.message.answer("⚠️ Корзина изменилась, проверьте заказ еще раз.")
+            await confirm_order(query.message, state)
+        return
     delivery_text = 'Самовывоз' if data['delivery_type'] == 'takeaway' else 'Доставка'
     admin_text = (f"🔔 *Новый заказ*\n\n"
                   f"*Клиент:* {data['name']}, {data['phone']}\n"
@@ -235,54 +426,42 @@ async def process_final_confirmation(query: CallbackQuery, state: FSMContext):
         admin_text += f"*Комментарий:* {data['comment']}\n"
     admin_text += "\n*Заказ:*\n" + "\n".join([f"▪️ {n} x {q} = {int(p * q)}р" for _, n, p, q in cart_items])
     admin_text += f"\n\n*Итого с доставкой: {int(final_total)} руб.*"
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute('''INSERT INTO orders (user_id, user_name, phone_number, delivery_type, address, comment, total_amount)
-                                     VALUES (?, ?, ?, ?, ?, ?, ?)''', (chat_id, data['name'], data['phone'], data['delivery_type'],
-                                     data.get('address', ''), data.get('comment', ''), final_total))
-        order_id = cursor.lastrowid
-        for _, name, price, quantity in cart_items:
-            await db.execute('INSERT INTO order_items (order_id, item_name, quantity, price_per_item) VALUES (?, ?, ?, ?)',
-                           (order_id, name, quantity, price))
-        await db.commit()
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, admin_text)
-            await bot.send_message(admin_id, f"Заказу присвоен номер `#{order_id}`")
-        except Exception as e:
-            logging.error(f"Failed to send message to admin {admin_id}: {e}")
+    admin_text += f"\n\n*Номер заказа:* `#{order_id}`"
+    admin_ids = list(ADMIN_IDS)
+    results = await asyncio.gather(*(bot.send_message(admin_id, admin_text) for admin_id in admin_ids),
+                                   return_exceptions=True)
+    for admin_id, result in zip(admin_ids, results):
+        if isinstance(result, Exception):
+            log.error("Failed to send message to admin %s: %s", admin_id, result)
     await query.message.edit_text(f"✅ Спасибо! Ваш заказ `#{order_id}` принят.", reply_markup=None)
     await query.message.answer("Вы можете сделать новый заказ.", reply_markup=get_main_menu_keyboard())
-    await db_query("DELETE FROM cart WHERE user_id = ?", (chat_id,), commit=True)
     await state.clear()
 
 # --- 6. UI & LOGIC FUNCTIONS (ADMIN) ---
 async def get_admin_panel(message_or_query):
-    builder = InlineKeyboardBuilder()
-    builder.button(text="Управление товарами", callback_data=AdminCallback(action="manage_items"))
-    builder.button(text="⚙️ Настройки", callback_data=AdminCallback(action="settings"))
-    builder.adjust(1)
     text = "Добро пожаловать в панель администратора."
     if isinstance(message_or_query, Message):
-        await message_or_query.answer(text, reply_markup=builder.as_markup())
+        await message_or_query.answer(text, reply_markup=ADMIN_PANEL_KB)
     elif isinstance(message_or_query, CallbackQuery):
-        await message_or_query.message.edit_text(text, reply_markup=builder.as_markup())
+        await message_or_query.message.edit_text(text, reply_markup=ADMIN_PANEL_KB)
 
 async def show_item_management_categories(query: CallbackQuery):
-    categories = await db_query("SELECT id, name FROM categories ORDER BY id")
-    builder = InlineKeyboardBuilder()
-    for cat_id, name in categories:
-        builder.button(text=name, callback_data=AdminCallback(action="view_cat_items", category_id=cat_id))
-    builder.adjust(2)
-    builder.row(InlineKeyboardButton(text="➕ Добавить категорию", callback_data=AdminCallback(action="add_category")))
-    builder.row(InlineKeyboardButton(text="➖ Удалить категорию", callback_data=AdminCallback(action="delete_category_menu")))
-    builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=AdminCallback(action="back_to_main")))
+    global _ADMIN_CATEGORIES_MARKUP
+    if _ADMIN_CATEGORIES_MARKUP is None:
+        builder = InlineKeyboardBuilder()
+        for cat_id, name in CATEGORIES_CACHE:
+            builder.button(text=name, callback_data=AdminCallback(action="view_cat_items", category_id=cat_id))
+        builder.adjust(2)
+        builder.row(InlineKeyboardButton(text="➕ Добавить категорию", callback_data=AdminCallback(action="add_category")))
+        builder.row(InlineKeyboardButton(text="➖ Удалить категорию", callback_data=AdminCallback(action="delete_category_menu")))
+        builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=AdminCallback(action="back_to_main")))
+        _ADMIN_CATEGORIES_MARKUP = builder.as_markup()
     await query.message.edit_text("Выберите категорию для управления товарами или воспользуйтесь опциями ниже:",
-                                  reply_markup=builder.as_markup())
+                                  reply_markup=_ADMIN_CATEGORIES_MARKUP)
 
 async def show_items_for_admin(query: CallbackQuery, category_id: int):
-    items = await db_query("SELECT id, name, price FROM menu_items WHERE category_id = ?", (category_id,))
     builder = InlineKeyboardBuilder()
-    for item_id, name, price in items:
+    for item_id, name, price in ITEMS_BY_CAT.get(category_id, []):
         builder.button(text=f"{name} - {int(price)}р", callback_data=AdminCallback(action="edit_item", item_id=item_id))
     builder.adjust(1)
     builder.row(InlineKeyboardButton(text="➕ Добавить новый товар",
@@ -293,7 +472,7 @@ async def show_items_for_admin(query: CallbackQuery, category_id: int):
                                   reply_markup=builder.as_markup())
 
 async def show_item_edit_menu(query: CallbackQuery, item_id: int):
-    item_name, cat_id = await db_query("SELECT name, category_id FROM menu_items WHERE id = ?", (item_id,), fetchone=True)
+    item_name, cat_id = await db_fetchone("SELECT name, category_id FROM menu_items WHERE id = ?", (item_id,))
     builder = InlineKeyboardBuilder()
     builder.button(text="✏️ Изменить цену", callback_data=AdminCallback(action="edit_price", item_id=item_id))
     builder.button(text="🗑️ Удалить товар", callback_data=AdminCallback(action="confirm_delete_item", item_id=item_id, category_id=cat_id))
@@ -303,8 +482,7 @@ async def show_item_edit_menu(query: CallbackQuery, item_id: int):
     await query.message.edit_text(f"Редактирование товара: *{item_name}*", reply_markup=builder.as_markup())
 
 async def show_admin_settings(query: CallbackQuery):
-    settings_list = await db_query("SELECT key, value FROM settings")
-    settings = {key: value for key, value in settings_list}
+    settings = SETTINGS_CACHE
     text = (f"⚙️ *Настройки бота*\n\n"
             f"🚚 *Стоимость доставки:* {int(settings.get('delivery_fee', 0))} руб.\n"
             f"🎉 *Бесплатная доставка от:* {int(settings.get('free_delivery_threshold', 0))} руб.")
@@ -318,17 +496,17 @@ async def show_admin_settings(query: CallbackQuery):
     await query.message.edit_text(text, reply_markup=builder.as_markup())
     
 async def show_categories_for_deletion(query: CallbackQuery):
-    categories = await db_query("SELECT id, name FROM categories ORDER BY id")
     builder = InlineKeyboardBuilder()
-    if not categories:
+    if not CATEGORIES_CACHE:
         builder.button(text="Нет категорий для удаления", callback_data="no_op")
     else:
-        for cat_id, name in categories:
+        for cat_id, name in CATEGORIES_CACHE:
             builder.button(text=f"❌ {name}", callback_data=AdminCallback(action="confirm_delete_category", category_id=cat_id))
     builder.adjust(1)
     builder.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=AdminCallback(action="manage_items")))
-    await query.message.edit_text("Выберите категорию для удаления. ВНИМАНИЕ: это удалит все товары внутри нее.",
-                                  reply_markup=builder.as_markup())
+    await edit_message(query.message.chat.id, query.message.message_id,
+                       "Выберите категорию для удаления. ВНИМАНИЕ: это удалит все товары внутри нее.",
+                       builder.as_markup(), query.message.text)
 
 # --- 7. MESSAGE HANDLERS (GENERAL) ---
 @dp.message(CommandStart())
@@ -344,31 +522,27 @@ async def show_menu(message: Message, state: FSMContext):
 # --- 8. MESSAGE HANDLERS (FSM - ORDERING) ---
 @dp.message(OrderState.awaiting_name)
 async def process_name(message: Message, state: FSMContext):
+    if message.text is None:
+        await message.answer("📝 Введите ваше имя:")
+        return
     await state.update_data(name=message.text)
     await message.answer("Спасибо! Теперь отправьте ваш номер телефона.",
-                         reply_markup=ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="📱 Отправить мой контакт", request_contact=True)]],
-                                                          resize_keyboard=True, one_time_keyboard=True))
+                         reply_markup=CONTACT_KB)
     await state.set_state(OrderState.awaiting_phone)
 
 @dp.message(OrderState.awaiting_phone, F.contact)
 async def process_phone_contact(message: Message, state: FSMContext):
     await state.update_data(phone=message.contact.phone_number)
     await message.answer("Ваш номер принят.", reply_markup=ReplyKeyboardRemove())
-    builder = InlineKeyboardBuilder()
-    builder.button(text="🏃 Самовывоз", callback_data='delivery:takeaway')
-    builder.button(text="🚚 Доставка", callback_data='delivery:delivery')
-    await message.answer("Выберите способ получения:", reply_markup=builder.as_markup())
+    await message.answer("Выберите способ получения:", reply_markup=DELIVERY_KB)
 
 @dp.message(OrderState.awaiting_phone)
 async def process_phone_text(message: Message, state: FSMContext):
-    phone = re.sub(r'\D', '', message.text)
+    phone = PHONE_DIGITS_RE.sub('', message.text or '')
     if 10 <= len(phone) <= 15:
         await state.update_data(phone=message.text)
         await message.answer("Ваш номер принят.", reply_markup=ReplyKeyboardRemove())
-        builder = InlineKeyboardBuilder()
-        builder.button(text="🏃 Самовывоз", callback_data='delivery:takeaway')
-        builder.button(text="🚚 Доставка", callback_data='delivery:delivery')
-        await message.answer("Выберите способ получения:", reply_markup=builder.as_markup())
+        await message.answer("Выберите способ получения:", reply_markup=DELIVERY_KB)
     else:
         await message.answer("❌ Неверный формат номера. Попробуйте еще раз.")
 
@@ -383,25 +557,32 @@ async def process_address(message: Message, state: FSMContext):
 
 @dp.message(OrderState.awaiting_comment)
 async def process_comment(message: Message, state: FSMContext):
-    if message.text.lower().strip() not in ['нет', 'no', '-']:
+    if message.text and message.text.strip().lower() not in NEG_ANSWERS:
         await state.update_data(comment=message.text)
     await confirm_order(message, state)
 
 # --- 9. MESSAGE HANDLERS (FSM - ADMIN) ---
 @dp.message(AdminState.awaiting_new_category_name)
 async def process_new_category_name(message: Message, state: FSMContext):
+    if message.text is None:
+        await message.answer("Введите название новой категории:")
+        return
     cat_name = message.text.strip()
-    exists = await db_query("SELECT id FROM categories WHERE name = ?", (cat_name,), fetchone=True)
+    exists = await db_fetchone("SELECT id FROM categories WHERE name = ?", (cat_name,))
     if exists:
         await message.answer("❌ Категория с таким названием уже существует.")
     else:
-        await db_query("INSERT INTO categories (name) VALUES (?)", (cat_name,), commit=True)
+        await db_execute("INSERT INTO categories (name) VALUES (?)", (cat_name,))
+        await refresh_menu_cache()
         await message.answer(f"✅ Категория '{cat_name}' успешно добавлена.")
         await state.clear()
         await get_admin_panel(message)
 
 @dp.message(AdminState.await_new_item_name)
 async def process_new_item_name(message: Message, state: FSMContext):
+    if message.text is None:
+        await message.answer("Введите название нового товара:")
+        return
     await state.update_data(name=message.text)
     await message.answer("Отлично. Теперь введите цену товара (только цифры):")
     await state.set_state(AdminState.await_new_item_price)
@@ -409,22 +590,28 @@ async def process_new_item_name(message: Message, state: FSMContext):
 @dp.message(AdminState.await_new_item_price)
 async def process_new_item_price(message: Message, state: FSMContext):
     try:
-        price = float(message.text)
+        price = float(message.text or '')
         data = await state.get_data()
-        await db_query("INSERT INTO menu_items (name, price, category_id) VALUES (?, ?, ?)",
-                       (data['name'], price, data['category_id']), commit=True)
+        await db_execute("INSERT INTO menu_items (name, price, category_id) VALUES (?, ?, ?)",
+                         (data['name'], price, data['category_id']))
+        await refresh_menu_cache()
         await message.answer(f"✅ Товар '{data['name']}' успешно добавлен!")
         await state.clear()
         await get_admin_panel(message)
     except ValueError:
         await message.answer("Ошибка: цена должна быть числом. Попробуйте снова.")
+    except aiosqlite.IntegrityError:
+        await message.answer("❌ Эта категория больше не существует.")
+        await state.clear()
+        await get_admin_panel(message)
 
 @dp.message(AdminState.await_new_price)
 async def process_new_price(message: Message, state: FSMContext):
     try:
-        new_price = float(message.text)
+        new_price = float(message.text or '')
         data = await state.get_data()
-        await db_query("UPDATE menu_items SET price = ? WHERE id = ?", (new_price, data['item_id']), commit=True)
+        await db_execute("UPDATE menu_items SET price = ? WHERE id = ?", (new_price, data['item_id']))
+        await refresh_menu_cache()
         await message.answer(f"✅ Цена успешно обновлена до {int(new_price)} руб.")
         await state.clear()
         await get_admin_panel(message)
@@ -434,9 +621,10 @@ async def process_new_price(message: Message, state: FSMContext):
 @dp.message(AdminState.await_new_setting_value)
 async def process_new_setting_value(message: Message, state: FSMContext):
     try:
-        new_value = float(message.text)
+        new_value = float(message.text or '')
         data = await state.get_data()
-        await db_query("UPDATE settings SET value = ? WHERE key = ?", (new_value, data['key']), commit=True)
+        await db_execute("UPDATE settings SET value = ? WHERE key = ?", (new_value, data['key']))
+        SETTINGS_CACHE[data['key']] = new_value
         await message.answer("✅ Настройка успешно обновлена!")
         await state.clear()
         await get_admin_panel(message)
@@ -451,13 +639,28 @@ async def handle_category_selection(q: CallbackQuery, callback_data: CategoryCal
 
 @dp.callback_query(ItemCallback.filter())
 async def handle_item_selection(q: CallbackQuery, callback_data: ItemCallback):
-    await db_query("INSERT OR REPLACE INTO cart (user_id, item_id, quantity) VALUES (?, ?, COALESCE((SELECT quantity FROM cart WHERE user_id = ? AND item_id = ?), 0) + 1)",
-                   (q.from_user.id, callback_data.id, q.from_user.id, callback_data.id), commit=True)
+    try:
+        async with transaction():
+            await DB.execute("INSERT INTO cart (user_id, item_id, quantity) VALUES (?, ?, 1) "
+                             "ON CONFLICT (user_id, item_id) DO UPDATE SET quantity = quantity + 1",
+                             (q.from_user.id, callback_data.id))
+            cart = CART_CACHE.get(q.from_user.id)
+            if cart is not None:
+                if callback_data.id in cart:
+                    name, price, quantity = cart[callback_data.id]
+                    cart[callback_data.id] = (name, price, quantity + 1)
+                else:
+                    del CART_CACHE[q.from_user.id]  # reloaded with the new item's name and price on next view
+    except aiosqlite.IntegrityError:
+        await q.answer("❌ Этот товар больше недоступен.", show_alert=True)
+        return
     await q.answer("✅ Добавлено в корзину!")
 
 @dp.callback_query(RemoveFromCartCallback.filter())
 async def handle_remove_from_cart(q: CallbackQuery, callback_data: RemoveFromCartCallback):
-    await db_query("DELETE FROM cart WHERE user_id = ? AND item_id = ?", (q.from_user.id, callback_data.item_id), commit=True)
+    async with transaction():
+        await DB.execute("DELETE FROM cart WHERE user_id = ? AND item_id = ?", (q.from_user.id, callback_data.item_id))
+        CART_CACHE.get(q.from_user.id, {}).pop(callback_data.item_id, None)
     await q.answer("🗑️ Удалено из корзины")
     await show_cart(q.from_user.id, q.message.message_id)
 
@@ -473,13 +676,15 @@ async def handle_view_cart(q: CallbackQuery):
 
 @dp.callback_query(F.data == 'clear_cart')
 async def handle_clear_cart(q: CallbackQuery):
-    await db_query("DELETE FROM cart WHERE user_id = ?", (q.from_user.id,), commit=True)
+    async with transaction():
+        await DB.execute("DELETE FROM cart WHERE user_id = ?", (q.from_user.id,))
+        CART_CACHE.pop(q.from_user.id, None)
     await q.answer("🗑️ Корзина очищена")
     await show_categories(q.message, q.message.message_id)
 
 @dp.callback_query(F.data == 'checkout')
 async def handle_checkout(q: CallbackQuery, state: FSMContext):
-    cart_exists = await db_query("SELECT 1 FROM cart WHERE user_id = ?", (q.from_user.id,), fetchone=True)
+    cart_exists = await db_fetchone("SELECT 1 FROM cart WHERE user_id = ? LIMIT 1", (q.from_user.id,))
     if not cart_exists:
         await q.answer("Ваша корзина пуста!", show_alert=True)
         return
@@ -518,99 +723,114 @@ async def admin_panel_command(message: Message, state: FSMContext):
     await state.clear()
     await get_admin_panel(message)
 
-@dp.callback_query(AdminCallback.filter(F.action == "back_to_main"), F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(AdminCallback.filter(F.action == "back_to_main"))
 async def admin_back_to_main(q: CallbackQuery, state: FSMContext):
     await state.clear()
     await get_admin_panel(q)
-    await q.answer()
 
-@dp.callback_query(AdminCallback.filter(F.action == "manage_items"), F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(AdminCallback.filter(F.action == "manage_items"))
 async def admin_manage_items(q: CallbackQuery):
     await show_item_management_categories(q)
-    await q.answer()
 
-@dp.callback_query(AdminCallback.filter(F.action == "settings"), F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(AdminCallback.filter(F.action == "settings"))
 async def admin_settings(q: CallbackQuery):
     await show_admin_settings(q)
-    await q.answer()
 
 # Category Management
-@dp.callback_query(AdminCallback.filter(F.action == "add_category"), F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(AdminCallback.filter(F.action == "add_category"))
 async def admin_add_category(q: CallbackQuery, state: FSMContext):
-    await q.message.answer("Введите название новой категории:")
-    await state.set_state(AdminState.awaiting_new_category_name)
-    await q.answer()
+    await asyncio.gather(state.set_state(AdminState.awaiting_new_category_name),
+                         bot.edit_message_text("Введите название новой категории:", q.message.chat.id, q.message.message_id,
+                                               reply_markup=ADMIN_CANCEL_KB))
 
-@dp.callback_query(AdminCallback.filter(F.action == "delete_category_menu"), F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(AdminCallback.filter(F.action == "delete_category_menu"))
 async def admin_delete_category_menu(q: CallbackQuery):
     await show_categories_for_deletion(q)
-    await q.answer()
 
-@dp.callback_query(AdminCallback.filter(F.action == "confirm_delete_category"), F.from_user.id.in_(ADMIN_IDS))
-async def admin_confirm_delete_category(q: CallbackQuery, callback_data: AdminCallback):
+@admin_router.callback_query(AdminCallback.filter(F.action == "confirm_delete_category"))
+@flags.callback_answer(pre=False)
+async def admin_confirm_delete_category(q: CallbackQuery, callback_data: AdminCallback, callback_answer: CallbackAnswer):
     cat_id = callback_data.category_id
-    await db_query("DELETE FROM cart WHERE item_id IN (SELECT id FROM menu_items WHERE category_id = ?)", (cat_id,), commit=True)
-    await db_query("DELETE FROM menu_items WHERE category_id = ?", (cat_id,), commit=True)
-    await db_query("DELETE FROM categories WHERE id = ?", (cat_id,), commit=True)
-    await q.answer("🗑️ Категория и все товары в ней удалены.", show_alert=True)
+    # Child rows are deleted explicitly: databases created before ON DELETE CASCADE was declared don't cascade
+    async with transaction():
+        await DB.execute("DELETE FROM cart WHERE item_id IN (SELECT id FROM menu_items WHERE category_id = ?)", (cat_id,))
+        await DB.execute("DELETE FROM menu_items WHERE category_id = ?", (cat_id,))
+        await DB.execute("DELETE FROM categories WHERE id = ?", (cat_id,))
+    await refresh_menu_cache()
+    callback_answer.text = "🗑️ Категория и все товары в ней удалены."
     await show_categories_for_deletion(q)
 
 # Item Management
-@dp.callback_query(AdminCallback.filter(F.action == "view_cat_items"), F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(AdminCallback.filter(F.action == "view_cat_items"))
 async def admin_view_cat_items(q: CallbackQuery, callback_data: AdminCallback):
     await show_items_for_admin(q, callback_data.category_id)
-    await q.answer()
     
-@dp.callback_query(AdminCallback.filter(F.action == "add_item"), F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(AdminCallback.filter(F.action == "add_item"))
 async def admin_add_item(q: CallbackQuery, state: FSMContext, callback_data: AdminCallback):
-    await state.set_data({'category_id': callback_data.category_id})
-    await q.message.answer("Введите название нового товара:")
-    await state.set_state(AdminState.await_new_item_name)
-    await q.answer()
+    await asyncio.gather(state.set_data({'category_id': callback_data.category_id}),
+                         state.set_state(AdminState.await_new_item_name),
+                         bot.edit_message_text("Введите название нового товара:", q.message.chat.id, q.message.message_id,
+                                               reply_markup=ADMIN_CANCEL_KB))
     
-@dp.callback_query(AdminCallback.filter(F.action == "edit_item"), F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(AdminCallback.filter(F.action == "edit_item"))
 async def admin_edit_item(q: CallbackQuery, callback_data: AdminCallback):
     await show_item_edit_menu(q, callback_data.item_id)
-    await q.answer()
 
-@dp.callback_query(AdminCallback.filter(F.action == "edit_price"), F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(AdminCallback.filter(F.action == "edit_price"))
 async def admin_edit_price(q: CallbackQuery, state: FSMContext, callback_data: AdminCallback):
-    await state.set_data({'item_id': callback_data.item_id})
-    await q.message.answer("Введите новую цену товара:")
-    await state.set_state(AdminState.await_new_price)
-    await q.answer()
+    await asyncio.gather(state.set_data({'item_id': callback_data.item_id}),
+                         state.set_state(AdminState.await_new_price),
+                         bot.edit_message_text("Введите новую цену товара:", q.message.chat.id, q.message.message_id,
+                                               reply_markup=ADMIN_CANCEL_KB))
     
-@dp.callback_query(AdminCallback.filter(F.action == "confirm_delete_item"), F.from_user.id.in_(ADMIN_IDS))
-async def admin_confirm_delete_item(q: CallbackQuery, callback_data: AdminCallback):
+@admin_router.callback_query(AdminCallback.filter(F.action == "confirm_delete_item"))
+@flags.callback_answer(pre=False)
+async def admin_confirm_delete_item(q: CallbackQuery, callback_data: AdminCallback, callback_answer: CallbackAnswer):
     item_id = callback_data.item_id
-    await db_query("DELETE FROM cart WHERE item_id = ?", (item_id,), commit=True)
-    await db_query("DELETE FROM menu_items WHERE id = ?", (item_id,), commit=True)
-    await q.answer("🗑️ Товар удален.", show_alert=True)
+    async with transaction():
+        await DB.execute("DELETE FROM cart WHERE item_id = ?", (item_id,))
+        await DB.execute("DELETE FROM menu_items WHERE id = ?", (item_id,))
+    await refresh_menu_cache()
+    callback_answer.text = "🗑️ Товар удален."
     await show_items_for_admin(q, callback_data.category_id)
     
 # Settings Management
-@dp.callback_query(AdminCallback.filter(F.action == "edit_setting"), F.from_user.id.in_(ADMIN_IDS))
+@admin_router.callback_query(AdminCallback.filter(F.action == "edit_setting"))
 async def admin_edit_setting(q: CallbackQuery, state: FSMContext, callback_data: AdminCallback):
     key = callback_data.setting_key
-    await state.set_data({'key': key})
-    prompt_text = "Введите новую стоимость доставки:" if key == "delivery_fee" else "Введите новый порог для бесплатной доставки:"
-    await q.message.answer(prompt_text)
-    await state.set_state(AdminState.await_new_setting_value)
-    await q.answer()
+    prompt_text = SETTING_PROMPTS[key]
+    await asyncio.gather(state.set_data({'key': key}), state.set_state(AdminState.await_new_setting_value),
+                         bot.edit_message_text(prompt_text, q.message.chat.id, q.message.message_id,
+                                               reply_markup=ADMIN_CANCEL_KB))
     
 # --- 12. START POLLING ---
 async def main():
+    global DB
     if not BOT_TOKEN:
-        logging.critical("No BOT_TOKEN found. Please set it in your .env file.")
+        log.critical("No BOT_TOKEN found. Please set it in your .env file.")
         return
     if not ADMIN_IDS:
-        logging.warning("No ADMIN_IDS found. Admin panel will be inaccessible.")
-    await init_db()
-    logging.info("Bot is starting...")
-    await dp.start_polling(bot)
+        log.warning("No ADMIN_IDS found. Admin panel will be inaccessible.")
+    dp.include_router(admin_router)
+    DB = await open_db()
+    for _ in range(DB_READERS):
+        READERS.put_nowait(await open_db(query_only=True))
+    try:
+        await init_db()
+        log.info("Bot is starting...")
+        await dp.start_polling(bot)
+    finally:
+        await DB.close()
+        while not READERS.empty():
+            await READERS.get_nowait().close()
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        if uvloop:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
-        logging.info("Bot stopped.")
+        log.info("Bot stopped.")
+    finally:
+        log_listener.stop()